@@ -1,6 +1,10 @@
+import concurrent.futures
+import copy
 import datetime
+import functools
 import iso3166
 import logging
+import os
 import pandas
 import typing
 import numpy
@@ -8,6 +12,11 @@ import numpy
 import fbprophet
 import holidays
 
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
+
 _log = logging.getLogger(__file__)
 
 
@@ -16,6 +25,130 @@ NamedDates = typing.Dict[datetime.datetime, str]
 ForecastingResult = typing.Tuple[
     pandas.Series, fbprophet.Prophet, pandas.DataFrame, NamedDates
 ]
+StanInit = typing.Dict[str, typing.Union[float, numpy.ndarray]]
+
+# default number of MCMC samples, and of chains that (py)stan samples in parallel for each fit
+_MCMC_SAMPLES = 500
+_MCMC_CHAINS = 4
+
+# memoized country lookups: ISO-3166 code → alpha-3 code → `holidays` class
+_ALPHA3: typing.Dict[str, str] = {}
+_COUNTRY_CLS: typing.Dict[str, type] = {}
+
+
+def _as_region_list(
+    region: typing.Optional[typing.Union[str, typing.Sequence[str]]]
+) -> typing.List[str]:
+    """ Normalizes a `region` argument (None, one region or several regions) to a list."""
+    if not region:
+        return []
+    if isinstance(region, str):
+        return [region]
+    return list(region)
+
+
+def _get_country_cls(country: str) -> typing.Tuple[str, type]:
+    """ Looks up the ISO-3166 alpha-3 code and the `holidays` class of a country.
+
+    Both lookups are memoized in module-level dictionaries.
+    """
+    if country not in _ALPHA3:
+        _ALPHA3[country] = iso3166.countries.get(country).alpha3
+    alpha3 = _ALPHA3[country]
+    if alpha3 not in _COUNTRY_CLS:
+        if not hasattr(holidays, alpha3):
+            raise KeyError(f'Country "{alpha3}" was not found in the `holidays` package.')
+        _COUNTRY_CLS[alpha3] = getattr(holidays, alpha3)
+    return alpha3, _COUNTRY_CLS[alpha3]
+
+
+def _copy_holidays(named_dates: holidays.HolidayBase) -> holidays.HolidayBase:
+    """ Copies a holidays table, such that expanding the copy to new years leaves it untouched."""
+    result = copy.copy(named_dates)
+    # the shallow copy would otherwise share the set of already populated years
+    result.years = set(result.years)
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _get_region_holidays(
+    country_cls: type, years_key: typing.Tuple[int, ...], **region_kwargs
+) -> holidays.HolidayBase:
+    """ Cached construction of the national holidays, or those of one province/state
+    (with `prov=` or `state=`). The returned objects are shared and must not be mutated.
+    """
+    return country_cls(years=list(years_key), **region_kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_holidays_cached(
+    country: str,
+    region_key: typing.Union[str, typing.Tuple[str, ...]],
+    years_key: typing.Tuple[int, ...],
+) -> holidays.HolidayBase:
+    """ Cached implementation of `get_holidays` with hashable, canonical arguments.
+    The returned objects are shared and must not be mutated.
+    """
+    country, country_cls = _get_country_cls(country)
+    use_states = hasattr(country_cls, "STATES")
+
+    if region_key == "all":
+        # select all
+        regions = country_cls.STATES if use_states else country_cls.PROVINCES
+    else:
+        regions = _as_region_list(region_key)
+
+    # copy the cached national holidays before merging the regional ones into them
+    result = _copy_holidays(_get_region_holidays(country_cls, years_key))
+    for region in regions:
+        is_province = region in country_cls.PROVINCES
+        is_state = use_states and region in country_cls.STATES
+        if is_province:
+            result.update(_get_region_holidays(country_cls, years_key, prov=region))
+        elif is_state:
+            result.update(_get_region_holidays(country_cls, years_key, state=region))
+        else:
+            raise KeyError(
+                f'Region "{region}" not found in {country} states or provinces.'
+            )
+    return result
+
+
+def _apply_predictions_numpy(
+    values: numpy.ndarray, mask: numpy.ndarray, yhat: numpy.ndarray, ymax: float
+) -> None:
+    """ Writes `yhat`, clipped to [0, ymax], into `values` where `mask` is True (in-place)."""
+    values[mask] = numpy.clip(yhat[mask], 0, ymax)
+    return
+
+
+def _apply_predictions_loop(
+    values: numpy.ndarray, mask: numpy.ndarray, yhat: numpy.ndarray, ymax: float
+) -> None:
+    """ Single-pass loop implementation of `_apply_predictions_numpy` for JIT compilation."""
+    for i in range(values.shape[0]):
+        if mask[i]:
+            v = yhat[i]
+            if v < 0:
+                v = 0.0
+            elif v > ymax:
+                v = ymax
+            values[i] = v
+    return
+
+
+# numba is optional: fall back to the numpy implementation if it is not installed.
+# Compilation happens at the first call and is cached on disk (cache=True), so worker processes
+# load the compiled kernel instead of recompiling it - negligible next to a Prophet fit.
+if numba is not None:
+    _apply_predictions = numba.njit(cache=True)(_apply_predictions_loop)
+else:
+    _apply_predictions = _apply_predictions_numpy
+
+
+def _to_np_dates(named_dates: NamedDates) -> numpy.ndarray:
+    """ Converts the dates of a holiday dictionary to a sorted `datetime64[D]` array."""
+    return numpy.array(sorted(named_dates), dtype="datetime64[D]")
 
 
 def get_holidays(
@@ -44,33 +177,35 @@ def get_holidays(
     holidays : dict
         datetime as keys, name of holiday as value
     """
-    country = iso3166.countries.get(country).alpha3
-    if not hasattr(holidays, country):
-        raise KeyError(f'Country "{country}" was not found in the `holidays` package.')
-    country_cls = getattr(holidays, country)
-    use_states = hasattr(country_cls, "STATES")
-
     if not region:
-        region = []
-    if region == "all":
-        # select all
-        regions = country_cls.STATES if use_states else country_cls.PROVINCES
+        region_key = ()
+    elif isinstance(region, str):
+        region_key = region
     else:
-        regions = numpy.atleast_1d(region)
+        region_key = tuple(sorted(region))
+    # the cached table is shared, so every caller gets its own copy
+    return _copy_holidays(_get_holidays_cached(country, region_key, tuple(sorted(set(years)))))
 
-    result = country_cls(years=years)
-    for region in regions:
-        is_province = region in country_cls.PROVINCES
-        is_state = use_states and region in country_cls.STATES
-        if is_province:
-            result.update(country_cls(years=years, prov=region))
-        elif is_state:
-            result.update(country_cls(years=years, state=region))
-        else:
-            raise KeyError(
-                f'Region "{region}" not found in {country} states or provinces.'
-            )
-    return result
+
+def get_stan_init(m: fbprophet.Prophet) -> StanInit:
+    """ Extracts the parameters of a fitted model to initialize the fit of another model.
+
+    Parameters
+    ----------
+    m : fbprophet.Prophet
+        a fitted prophet model (MAP or MCMC)
+
+    Returns
+    -------
+    stan_init : dict
+        (posterior mean) values of the Stan parameters
+    """
+    stan_init = {}
+    for pname in ["k", "m", "sigma_obs"]:
+        stan_init[pname] = float(numpy.mean(m.params[pname]))
+    for pname in ["delta", "beta"]:
+        stan_init[pname] = numpy.mean(m.params[pname], axis=0)
+    return stan_init
 
 
 def predict_testcounts(
@@ -83,6 +218,7 @@ def predict_testcounts(
     ignore_before: typing.Optional[
         typing.Union[datetime.datetime, pandas.Timestamp, str]
     ] = None,
+    warm_start: typing.Optional[StanInit] = None,
     **kwargs,
 ) -> ForecastingResult:
     """ Predict/smooth missing test counts with Prophet.
@@ -111,10 +247,16 @@ def predict_testcounts(
     ignore_before : timestamp
         all dates before this are ignored
         Use this argument to prevent an unrealistic upwards trend due to initial testing ramp-up
+    warm_start : optional, dict
+        initial values for the Stan fit, for example from `get_stan_init` of a similar model
+        The shapes of "delta" (number of changepoints, which depends on the length of the fit
+        window) and "beta" (seasonality & holiday features) must match. Otherwise the model is
+        fitted from the default initialization.
     **kwargs
         optional kwargs for the `fbprophet.Prophet`. For example:
         * growth: 'linear' or 'logistic' (default)
         * seasonality_mode: 'additive' or 'multiplicative' (default)
+        * mcmc_samples: 0 for a (much faster) MAP fit instead of MCMC (default: 500)
 
     Returns
     -------
@@ -132,19 +274,21 @@ def predict_testcounts(
     if not ignore_before:
         ignore_before = testcounts.index[0]
 
-    # for safety, sort the index
-    testcounts.sort_index(inplace=True)
+    # for safety, sort the index (usually it is already sorted)
+    if not testcounts.index.is_monotonic_increasing:
+        testcounts.sort_index(inplace=True)
 
-    mask_fit = testcounts.index >= ignore_before
+    # compare on the raw datetime64 values to bypass the pandas comparison machinery
+    mask_fit = testcounts.index.values >= pandas.Timestamp(ignore_before).to_datetime64()
     if keep_data:
-        mask_predict = numpy.logical_and(
-            testcounts.index >= ignore_before, numpy.isnan(testcounts.values)
-        )
+        # combine in-place to avoid temporary boolean arrays
+        mask_predict = numpy.isnan(testcounts.values)
+        numpy.logical_and(mask_predict, mask_fit, out=mask_predict)
     else:
-        mask_predict = testcounts.index >= ignore_before
+        mask_predict = mask_fit
 
     years = set([testcounts.index[0].year, testcounts.index[-1].year])
-    regions = numpy.atleast_1d(region)
+    regions = _as_region_list(region)
 
     if region != "all" and len(regions) <= 1 and regional_holidays:
         raise ValueError(
@@ -157,16 +301,18 @@ def predict_testcounts(
         all_holidays = get_holidays(country, region, years=years)
         national_holidays = get_holidays(country, region=None, years=years)
 
+        # membership is tested on contiguous datetime64 arrays instead of hashing dates
+        all_dates = numpy.array(list(all_holidays.keys()), dtype="datetime64[D]")
         holiday_df = pandas.DataFrame(
-            data=[
-                (
-                    date,
-                    name,
-                    "national" if date in national_holidays.keys() else "regional",
-                )
-                for date, name in all_holidays.items()
-            ],
-            columns=["ds", "name", "holiday"],
+            dict(
+                ds=pandas.to_datetime(all_dates),
+                name=list(all_holidays.values()),
+                holiday=numpy.where(
+                    numpy.isin(all_dates, _to_np_dates(national_holidays)),
+                    "national",
+                    "regional",
+                ),
+            )
         )
     else:
         # none, or only one region -> no distinction between national/regional holidays
@@ -180,7 +326,9 @@ def predict_testcounts(
         )
 
     # Config settings of forecast model
-    days = (testcounts.index[-1] - testcounts.index[0]).days
+    # the changepoints are only placed within the training window
+    fit_idx = testcounts.index[mask_fit]
+    days = (fit_idx[-1] - fit_idx[0]).days
     prophet_kwargs = dict(
         growth="logistic",
         seasonality_mode="multiplicative",
@@ -188,7 +336,7 @@ def predict_testcounts(
         weekly_seasonality=True,
         yearly_seasonality=False,
         holidays=holiday_df,
-        mcmc_samples=500,
+        mcmc_samples=_MCMC_SAMPLES,
         # restrict number of potential changepoints:
         n_changepoints=int(numpy.ceil(days / 30)),
     )
@@ -196,39 +344,73 @@ def predict_testcounts(
     prophet_kwargs.update(kwargs)
     m = fbprophet.Prophet(**prophet_kwargs)
 
-    # fit only the selected subset of the data
-    df_fit = (
-        testcounts.loc[mask_fit]
-        .reset_index()
-        .rename(columns={"date": "ds", "total": "y"})
-    )
-
+    # fit only the selected subset of the data, but predict for all dates in the input
+    # (single precision suffices for test counts, Prophet casts to double for Stan anyway)
+    fit_columns = dict(ds=fit_idx.values, y=testcounts.values[mask_fit].astype("float32"))
+    predict_columns = dict(ds=testcounts.index.values)
     if prophet_kwargs["growth"] == "logistic":
-        cap = numpy.max(testcounts) * 1
-        df_fit["floor"] = 0
-        df_fit["cap"] = cap
-    m.fit(df_fit)
+        bounds = dict(floor=numpy.float32(0), cap=numpy.float32(numpy.max(testcounts)))
+        fit_columns.update(bounds)
+        predict_columns.update(bounds)
+    # the frames are built directly from the arrays to avoid intermediate copies
+    df_fit = pandas.DataFrame(fit_columns, copy=False)
+    df_predict = pandas.DataFrame(predict_columns, copy=False)
+
+    if warm_start is None:
+        m.fit(df_fit)
+    else:
+        # pystan only accepts a callable, the cmdstanpy backend validates a dict of inits
+        if m.stan_backend.get_type() == "PYSTAN":
+            init = lambda: warm_start
+        else:
+            init = warm_start
+        try:
+            m.fit(df_fit, init=init)
+        except (RuntimeError, ValueError) as ex:
+            # Stan rejects initial values with the wrong dimensions
+            if "mismatch in" not in str(ex):
+                raise
+            _log.warning("Unable to warm-start the fit. Fitting from default initialization.")
+            m = fbprophet.Prophet(**prophet_kwargs)
+            m.fit(df_fit)
 
-    # predict for all dates in the input
-    df_predict = testcounts.reset_index().rename(columns={"date": "ds"})
-    if prophet_kwargs["growth"] == "logistic":
-        df_predict["floor"] = 0
-        df_predict["cap"] = cap
     forecast = m.predict(df_predict)
 
     # make a series of the result that has the same index as the input
-    result = pandas.Series(
-        index=testcounts.index, data=testcounts.copy().values, name="testcount"
-    )
-    result.loc[mask_predict] = numpy.clip(
-        forecast.set_index("ds").yhat, 0, forecast.yhat.max()
-    )
+    # the forecast rows are sorted by "ds", just like the (sorted) input index
+    yhat = forecast["yhat"].to_numpy()
+    ymax = yhat.max()
+    values = testcounts.to_numpy(dtype=float, copy=True)
+    _apply_predictions(values, mask_predict, yhat, ymax)
+    result = pandas.Series(values, index=testcounts.index, name="testcount", copy=False)
     # full-length result series, model and forecast are returned
     return result, m, forecast, all_holidays
 
 
+def _predict_region(
+    testcounts: pandas.Series, country: str, region: str, kwargs: dict
+) -> ForecastingResult:
+    """ Runs `predict_testcounts` for one region of `predict_testcounts_all_regions`.
+
+    The result is made picklable, such that it is the same for all regions,
+    no matter whether it was computed in a worker process or not.
+    """
+    result, m, forecast, considered_holidays = predict_testcounts(
+        testcounts, country=country, region=region, **kwargs
+    )
+    # the Stan backend is not needed after fitting and does not pickle well
+    m.stan_backend = None
+    # `holidays.HolidayBase` objects can't be unpickled
+    return result, m, forecast, dict(considered_holidays)
+
+
 def predict_testcounts_all_regions(
-    df: pandas.DataFrame, country_alpha2: str, **predict_testcounts_kwargs
+    df: pandas.DataFrame,
+    country_alpha2: str,
+    *,
+    n_jobs: int = -1,
+    warm_start_from_first: bool = False,
+    **predict_testcounts_kwargs,
 ) -> typing.Tuple[pandas.Series, typing.Dict[str, ForecastingResult]]:
     """ Applies test count forecasting to all regions.
 
@@ -239,6 +421,17 @@ def predict_testcounts_all_regions(
         May contain a region "all" with the nation-wide sum.
     country_alpha2: str
         ISO-3166 alpha-2 short code of the country
+    n_jobs : int, default -1
+        number of worker processes for fitting the regions in parallel
+        if -1 (default): as many as the CPU cores allow, considering that the chains of
+        each MCMC fit are sampled in parallel processes as well
+        if 1: all regions are fitted sequentially in the current process
+    warm_start_from_first : bool, default False
+        if True, one region (preferably "all") is fitted first and its parameters are used
+        as `warm_start` for all other regions (unless `warm_start` is given explicitly)
+        This only helps regions whose fit window has as many changepoints as the first one.
+    **predict_testcounts_kwargs
+        optional kwargs for `predict_testcounts`
 
     Returns
     -------
@@ -246,14 +439,20 @@ def predict_testcounts_all_regions(
         the date-indexed series of predicted new tests
     results : dict of ForecastingResult
         the forecasting results for each region
+        To make them picklable, the Prophet models don't keep their Stan backend
+        and the holidays are plain dictionaries.
     """
     df = df.copy()
-    results = {}
-    # forecast testcounts in all regions
-    for region in df.index.levels[0]:
-        new_tests_nans = df.xs(region).new_tests.isna()
-        n_train = sum(~new_tests_nans)
-        if sum(~new_tests_nans) > 10:
+    groups = {region: df_region.droplevel(0) for region, df_region in df.groupby(level=0)}
+    jobs = {}
+    # collect the regions that have enough data for a forecast
+    for region, df_region in groups.items():
+        # the first valid date (below) is found by position, so the dates must be sorted
+        if not df_region.index.is_monotonic_increasing:
+            df_region = df_region.sort_index()
+        new_tests_nans = df_region.new_tests.isna().values
+        n_train = new_tests_nans.size - int(new_tests_nans.sum())
+        if n_train > 10:
             _log.info(
                 "Forecasting testcount gaps for %s from %d training points.",
                 region,
@@ -262,20 +461,58 @@ def predict_testcounts_all_regions(
             kwargs = dict(
                 keep_data=True,
                 growth="linear",
+                # the first date with data is found without materializing the filtered frame
                 ignore_before=max(
                     pandas.Timestamp("2020-03-15"),
-                    df.xs(region)[~new_tests_nans].reset_index().date[0],
+                    df_region.index[numpy.argmax(~new_tests_nans)],
                 ),
             )
             kwargs.update(predict_testcounts_kwargs)
-            results[region] = predict_testcounts(
-                df.xs(region).new_tests, country=country_alpha2, region=region, **kwargs
-            )
-            result_series = results[region][0]
-            numpy.testing.assert_array_equal(result_series.index, df.loc[region].index)
-            df.loc[region, "predicted_new_tests"] = result_series.values
+            jobs[region] = (df_region.new_tests, kwargs)
         else:
             _log.warning(
                 "Unable to forecast %s from just %d training points", region, n_train
             )
+
+    results = {}
+    if warm_start_from_first and jobs:
+        # fit one region first, to initialize all other fits from its parameters
+        region = "all" if "all" in jobs else next(iter(jobs))
+        testcounts, kwargs = jobs.pop(region)
+        results[region] = _predict_region(testcounts, country_alpha2, region, kwargs)
+        stan_init = get_stan_init(results[region][1])
+        for _, kwargs in jobs.values():
+            kwargs.setdefault("warm_start", stan_init)
+
+    # forecast testcounts in all (remaining) regions
+    if n_jobs > 0:
+        max_workers = n_jobs
+    else:
+        # Stan samples the chains of every MCMC fit in parallel, so leave room for them
+        mcmc = predict_testcounts_kwargs.get("mcmc_samples", _MCMC_SAMPLES) > 0
+        max_workers = max(1, (os.cpu_count() or 1) // (_MCMC_CHAINS if mcmc else 1))
+    max_workers = min(len(jobs), max_workers)
+    if max_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                region: pool.submit(
+                    _predict_region, testcounts, country_alpha2, region, kwargs
+                )
+                for region, (testcounts, kwargs) in jobs.items()
+            }
+            results.update({region: future.result() for region, future in futures.items()})
+    else:
+        results.update({
+            region: _predict_region(testcounts, country_alpha2, region, kwargs)
+            for region, (testcounts, kwargs) in jobs.items()
+        })
+
+    for region, (result_series, _, _, _) in results.items():
+        if len(result_series) != len(groups[region]):
+            raise ValueError(
+                f"The forecast for {region} has {len(result_series)} dates, "
+                f"but the input has {len(groups[region])}."
+            )
+        # align by date, because the results are sorted but the input may not be
+        df.loc[region, "predicted_new_tests"] = result_series.reindex(groups[region].index).values
     return df["predicted_new_tests"], results
@@ -1,12 +1,16 @@
 import datetime
+import logging
 from matplotlib import pyplot
 import numpy
 import os
 import pandas
 import pathlib
+import pickle
 import pytest
 import xarray
 
+import holidays
+
 import arviz
 import pymc3
 
@@ -15,6 +19,7 @@ from . import data
 from . import export
 from . import model
 from . import plotting
+from . import preprocessing
 
 
 IDATA_FILENAMES = [
@@ -88,6 +93,142 @@ class TestData:
             )
 
 
+def _mock_new_tests(regions, start="2020-03-01", end="2020-07-31") -> pandas.DataFrame:
+    """ Creates a [region, date]-indexed dataframe of new_tests with gaps."""
+    numpy.random.seed(456)
+    dfs = []
+    for r, region in enumerate(regions):
+        df = pandas.DataFrame(
+            index=pandas.date_range(start, end, freq="D", name="date"),
+            columns=["new_tests"],
+        )
+        df["region"] = region
+        trend = 100 + (r + 1) * numpy.arange(len(df))
+        weekly = 1 + 0.3 * (df.index.weekday < 5)
+        df["new_tests"] = trend * weekly * numpy.random.uniform(0.9, 1.1, size=len(df))
+        df.loc["2020-06-10":"2020-06-20", "new_tests"] = numpy.nan
+        dfs.append(df.reset_index().set_index(["region", "date"]))
+    return pandas.concat(dfs)
+
+
+class TestPreprocessing:
+    def test_apply_predictions(self):
+        values = numpy.array([1, numpy.nan, 3, numpy.nan, numpy.nan, 6], dtype=float)
+        mask = numpy.isnan(values)
+        mask[0] = True
+        yhat = numpy.array([-2, -1, 10, 4, 12, 7], dtype=float)
+        # clipped to 0 (negative), kept (masked), clipped to ymax (above max), untouched (unmasked)
+        expected = numpy.array([0, 0, 3, 4, 8, 6], dtype=float)
+        for fn in [preprocessing._apply_predictions_numpy, preprocessing._apply_predictions_loop]:
+            result = values.copy()
+            fn(result, mask, yhat, 8.0)
+            numpy.testing.assert_array_equal(result, expected)
+
+    def test_get_holidays(self):
+        years = [2020, 2021]
+        # reference without caching
+        expected = holidays.DEU(years=years)
+        for prov in ["BW", "BY"]:
+            expected.update(holidays.DEU(years=years, prov=prov))
+
+        result = preprocessing.get_holidays("DE", ["BY", "BW"], years=years)
+        assert isinstance(result, holidays.HolidayBase)
+        assert dict(result) == dict(expected)
+        # cached calls give equal, but independent results
+        again = preprocessing.get_holidays("DE", ("BW", "BY"), years=reversed(years))
+        assert again is not result
+        assert dict(again) == dict(expected)
+        result[datetime.date(2020, 5, 5)] = "Test day"
+        assert datetime.date(2020, 5, 5) not in preprocessing.get_holidays("DE", ["BY", "BW"], years)
+
+        national = preprocessing.get_holidays("DE", None, years=[2020])
+        assert dict(national) == dict(holidays.DEU(years=[2020]))
+        # like `holidays.HolidayBase`, the result expands to other years
+        assert datetime.date(2022, 1, 1) in national
+        # ...without affecting the (cached) tables of later calls
+        national = preprocessing.get_holidays("DE", None, years=[2020])
+        assert national.years == {2020}
+        assert datetime.date(2022, 1, 1) in national
+        assert len(preprocessing.get_holidays("US", "all", years)) > len(holidays.US(years=years))
+        with pytest.raises(KeyError, match="not found"):
+            preprocessing.get_holidays("DE", "XY", years)
+
+    @pytest.mark.parametrize("warm_start_from_first", [False, True])
+    def test_all_regions_parallel(self, warm_start_from_first):
+        df = _mock_new_tests(["all", "BW", "BY"]).sort_index()
+        df.loc[("BY", slice("2020-05-01", "2020-07-31")), "new_tests"] = numpy.nan
+        kwargs = dict(mcmc_samples=0, warm_start_from_first=warm_start_from_first)
+        expected, results_seq = preprocessing.predict_testcounts_all_regions(
+            df, "DE", n_jobs=1, **kwargs
+        )
+        result, results_par = preprocessing.predict_testcounts_all_regions(
+            df, "DE", n_jobs=2, **kwargs
+        )
+        numpy.testing.assert_allclose(result, expected, rtol=1e-4)
+        assert set(results_par) == set(results_seq) == {"all", "BW", "BY"}
+        for region in ["all", "BW", "BY"]:
+            for results in [results_seq, results_par]:
+                _, m, forecast, considered_holidays = results[region]
+                assert m.stan_backend is None
+                assert type(considered_holidays) is dict
+            numpy.testing.assert_allclose(
+                results_par[region][2].yhat, results_seq[region][2].yhat, rtol=1e-4
+            )
+        # the results of all paths can be pickled
+        pickle.loads(pickle.dumps(results_seq))
+
+    def test_warm_start(self, caplog, monkeypatch):
+        testcounts = _mock_new_tests(["all"]).xs("all").new_tests
+        kwargs = dict(country="DE", region=None, keep_data=False, growth="linear", mcmc_samples=0)
+        result, m, _, _ = preprocessing.predict_testcounts(testcounts.copy(), **kwargs)
+
+        # record the initial values that are passed to the fit
+        fit = preprocessing.fbprophet.Prophet.fit
+        passed_inits = []
+        def spy_fit(self, df, **fit_kwargs):
+            passed_inits.append(fit_kwargs.get("init"))
+            return fit(self, df, **fit_kwargs)
+        monkeypatch.setattr(preprocessing.fbprophet.Prophet, "fit", spy_fit)
+
+        with caplog.at_level(logging.WARNING):
+            result_warm, _, _, _ = preprocessing.predict_testcounts(
+                testcounts.copy(), warm_start=preprocessing.get_stan_init(m), **kwargs
+            )
+        # with matching shapes, the warm start must not fall back to the default initialization
+        assert "Unable to warm-start" not in caplog.text
+        assert len(passed_inits) == 1 and passed_inits[0] is not None
+        numpy.testing.assert_allclose(result_warm, result, rtol=0.01)
+
+    def test_warm_start_fallback(self):
+        testcounts = _mock_new_tests(["all"]).xs("all").new_tests
+        kwargs = dict(country="DE", region=None, keep_data=False, growth="linear", mcmc_samples=0)
+        result, m, _, _ = preprocessing.predict_testcounts(testcounts.copy(), **kwargs)
+        stan_init = preprocessing.get_stan_init(m)
+        assert set(stan_init) == {"k", "m", "sigma_obs", "delta", "beta"}
+        assert numpy.shape(stan_init["delta"]) == (m.params["delta"].shape[1],)
+
+        # initial values with mismatching shapes must not break the fit
+        stan_init["delta"] = numpy.zeros(len(stan_init["delta"]) + 3)
+        stan_init["beta"] = numpy.zeros(len(stan_init["beta"]) + 3)
+        result_warm, _, _, _ = preprocessing.predict_testcounts(
+            testcounts.copy(), warm_start=stan_init, **kwargs
+        )
+        numpy.testing.assert_allclose(result_warm, result, rtol=0.01)
+
+    def test_all_regions_unsorted(self):
+        df = _mock_new_tests(["all", "BY"])
+        # reverse the order of the dates in one region
+        df_unsorted = pandas.concat([
+            df.xs("all", drop_level=False),
+            df.xs("BY", drop_level=False)[::-1],
+        ])
+        expected, _ = preprocessing.predict_testcounts_all_regions(df, "DE", mcmc_samples=0)
+        result, _ = preprocessing.predict_testcounts_all_regions(df_unsorted, "DE", mcmc_samples=0)
+        # the predictions must end up at the same dates
+        numpy.testing.assert_array_equal(result.index, df_unsorted.index)
+        numpy.testing.assert_allclose(result.loc[df.index], expected, rtol=0.01)
+
+
 class TestModel:
     def test_build(self):
         from rtlive.sources import data_ch